@@ -1,14 +1,28 @@
 import os
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+
+# 每个 uvicorn worker 的 FAISS / BLAS 只用 1 个线程：单次检索很小，多线程收益有限，
+# 而 --workers N 时每个进程都开满核数的线程会互相抢占。必须在导入 numpy / faiss 之前设置
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+
+import asyncio
+import hashlib
+import logging
+import pickle
+import threading
+from contextlib import aclosing
+import diskcache
+import faiss
+import httpx
+import numpy as np
+import tiktoken
+from openai import AsyncOpenAI, RateLimitError
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_community.document_loaders import TextLoader
+from embeddings import BatchingEmbeddings, CachedEmbeddings, make_embeddings
+from ingest import load_documents, build_index
 
 # 1. Quick sanity check: make sure我们有 OpenAI 的 Key
 # 在本地需要手动 export，部署到 App Runner 时会通过 Secrets Manager 注入
@@ -17,8 +31,49 @@ if "OPENAI_API_KEY" not in os.environ:
 else:
     print("✅ OPENAI_API_KEY is set")
 
-# --- Lazy loading: 只在第一次调用 /chat 时才真正加载向量库和模型 ---
+# --- 进程级共享的 HTTP 连接池 ---
+# embeddings / LLM 的 OpenAI 客户端默认各自新建 httpx 客户端，每次调用都可能重新做 TCP+TLS 握手；
+# 这里统一复用同一组长连接，warm 请求可以省掉握手时间
+_HTTPX_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+_HTTPX = httpx.Client(limits=_HTTPX_LIMITS, timeout=30.0)
+_HTTPX_ASYNC = httpx.AsyncClient(limits=_HTTPX_LIMITS, timeout=30.0, http2=True)
+
+# --- 本地磁盘缓存（多个 worker 共享，重启后仍然有效） ---
+# 问题向量：LRU 淘汰，重复的问题不再请求 embeddings 接口
+# 完整回答：短 TTL，FAQ 类的重复问题直接返回，同时避免长期返回过期答案
+CACHE_DIR = os.environ.get("RAG_CACHE_DIR", "/tmp/rag_cache")
+ANSWER_CACHE_TTL = 300
+_embedding_cache = diskcache.Cache(
+    os.path.join(CACHE_DIR, "embeddings"),
+    eviction_policy="least-recently-used",
+    size_limit=2**28,
+)
+_answer_cache = diskcache.Cache(os.path.join(CACHE_DIR, "answers"))
+
+# HNSW 检索时的候选队列长度，越大召回越高、越慢
+HNSW_EF_SEARCH = 64
+
+def faiss_num_threads():
+    """从 OMP_NUM_THREADS 取 FAISS 线程数
+
+    OpenMP 允许 "4,2" 这样按嵌套层级的写法，这里取第一层；空值或无法解析时退回 1，不让启动失败
+    """
+    try:
+        return max(1, int(os.environ["OMP_NUM_THREADS"].split(",")[0]))
+    except ValueError:
+        return 1
+
+faiss.omp_set_num_threads(faiss_num_threads())
+
+# 使用 uvicorn 已配置好的 logger，异常栈会和访问日志一起输出
+logger = logging.getLogger("uvicorn.error")
+
+# OpenAI API 地址，启动时用来预热连接（与 openai SDK 一样支持 OPENAI_BASE_URL 覆盖）
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# --- 向量库和模型在启动时加载（见 preload_rag_chain），懒加载只作为启动失败时的兜底 ---
 rag_chain = None
+_rag_chain_lock = threading.Lock()
 
 def ensure_faiss_index():
     """如果 faiss_index 不存在，自动从 data.txt 生成"""
@@ -27,37 +82,27 @@ def ensure_faiss_index():
         if not os.path.exists("data.txt"):
             raise FileNotFoundError("data.txt not found. Cannot generate index.")
         
-        # 加载并处理文档
-        loader = TextLoader("./data.txt")
-        documents = loader.load()
-        text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-        docs = text_splitter.split_documents(documents)
-        
-        # 创建向量并存储
-        embeddings = OpenAIEmbeddings()
-        db = FAISS.from_documents(docs, embeddings)
-        db.save_local("faiss_index")
+        # 加载并切分文档，创建向量并存储（与 ingest.py 相同的流程）
+        docs = load_documents("./data.txt")
+        # build_index 会用 asyncio.run 在独立的事件循环里并发 embedding，并在该循环里
+        # 自行创建和关闭异步客户端，所以这里只传入同步的 _HTTPX
+        build_index(docs, "faiss_index", http_client=_HTTPX)
         print("✅ FAISS index generated successfully!")
 
-def get_rag_chain():
-    global rag_chain
-    if rag_chain is None:
-        print("Loading RAG model and vector store...")
-        
-        # 确保索引存在（如果不存在会自动生成）
-        ensure_faiss_index()
-
-        # 1) 加载本地 FAISS 索引（ingest.py 预处理生成），并建立检索器
-        embeddings = OpenAIEmbeddings()
-        vectorstore = FAISS.load_local(
-            "faiss_index", 
-            embeddings, 
-            allow_dangerous_deserialization=True 
-        )
-        retriever = vectorstore.as_retriever()
-        
-        # 2) 定义提示词模板：把检索的上下文和用户问题拼成一条完整的 Prompt
-        template = """Use the following pieces of context to answer the question.
+def load_index(path="faiss_index"):
+    """以 mmap 方式加载 FAISS 索引，多个 worker 进程共享操作系统的 page cache"""
+    # IO_FLAG_MMAP 只对 IVF 倒排表生效；IO_FLAG_MMAP_IFC（faiss>=1.11）会把 flat / SQ 的向量数据
+    # 也直接映射到文件上，HNSWSQ 索引的大部分内存因此不再复制到每个 worker 的私有堆里
+    index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP_IFC)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    # index.pkl 是 FAISS.save_local 写出的 (docstore, index_to_docstore_id)
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return index, docstore, index_to_docstore_id
+
+# 提示词模板：把检索的上下文和用户问题拼成一条完整的 Prompt
+PROMPT_TEMPLATE = """Use the following pieces of context to answer the question.
 If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
 Context: {context}
@@ -65,34 +110,198 @@ Context: {context}
 Question: {question}
 
 Helpful Answer: """
-        
-        prompt = ChatPromptTemplate.from_template(template)
-        
-        # 3) 选择要调用的 LLM（OpenAI gpt-3.5-turbo，temperature=0 让回答更稳定）
-        llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
-        
-        # 4) LCEL 管道：retriever -> prompt -> LLM -> 输出解析
-        def format_docs(docs):
-            return "\n\n".join([d.page_content for d in docs])
-        
-        rag_chain = (
-            {"context": retriever | format_docs, "question": RunnablePassthrough()}
-            | prompt
-            | llm
-            | StrOutputParser()
+
+# 模板是固定的，导入时就按占位符切成三段文本，每次请求只需拼接，
+# 不再解析格式字符串（模板里没有 {{ }} 转义，切分结果与 str.format 一致）
+_PROMPT_HEAD, _PROMPT_REST = PROMPT_TEMPLATE.split("{context}")
+_PROMPT_MID, _PROMPT_TAIL = _PROMPT_REST.split("{question}")
+
+def render_prompt(context, question):
+    return "".join((_PROMPT_HEAD, context, _PROMPT_MID, question, _PROMPT_TAIL))
+
+# 每个问题检索的文档数（与 as_retriever() 的默认值一致）
+RETRIEVER_K = 4
+
+# 回答问题所用的 LLM，以及拼进 Prompt 的上下文最多占用的 token 数
+LLM_MODEL = "gpt-3.5-turbo"
+OPENAI_MAX_RETRIES = 2
+# LLM 请求的超时：共享 httpx 客户端的 30 秒是给 embedding 用的，长回答可能超过它，
+# 超时后 SDK 会重试，同一个请求最多被计费 max_retries + 1 次，所以这里单独放宽
+LLM_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+CONTEXT_TOKEN_BUDGET = 1500
+
+def format_docs(chunks, encoding, separator_tokens):
+    # chunks 是按相似度从高到低排列的 (文本, token 数)，超出 token 预算时从相似度最低的开始丢弃，
+    # 避免上下文过长拖慢 LLM 生成、抬高费用。只收集一次要拼接的文本，再做一次 join
+    budget = CONTEXT_TOKEN_BUDGET
+    parts = []
+    for text, n_tokens in chunks:
+        cost = n_tokens + (separator_tokens if parts else 0)
+        if cost > budget:
+            if not parts:
+                # 最相关的一篇就超出预算时截断它，保证至少有一段上下文
+                tokens = encoding.encode_ordinary(text)
+                parts.append(encoding.decode(tokens[:budget]))
+            break
+        parts.append(text)
+        budget -= cost
+    return "\n\n".join(parts)
+
+class RAGChain:
+    """检索 -> 拼 Prompt -> 调 LLM 的固定流程
+
+    流程固定，热路径上不经过 LangChain：直接用 faiss 检索、预切分的模板拼 Prompt、
+    openai SDK 调用 LLM，省掉 Runnable / 回调 / pydantic 转换的开销
+    """
+
+    def __init__(self, index, docstore, index_to_docstore_id, embeddings, client, k=RETRIEVER_K):
+        self.index = index
+        # 分词器在构建链时才加载（镜像里已预先下载，本地首次运行 tiktoken 可能需要联网），
+        # 加载失败会走 get_rag_chain 的兜底逻辑，而不是让模块导入直接失败
+        self.encoding = tiktoken.encoding_for_model(LLM_MODEL)
+        self.separator_tokens = len(self.encoding.encode_ordinary("\n\n"))
+        # 按 faiss id 预先取出每个切片的文本和 token 数，检索时按下标直接取，
+        # 每次请求不再经过 docstore.search 和 metadata 查找；
+        # token 数优先用 ingest 时写入的 n_tokens，旧索引没有时在这里一次性补算
+        self.chunks = [None] * len(index_to_docstore_id)
+        for i, doc_id in index_to_docstore_id.items():
+            doc = docstore.search(doc_id)
+            n_tokens = doc.metadata.get("n_tokens")
+            if n_tokens is None:
+                n_tokens = len(self.encoding.encode_ordinary(doc.page_content))
+            self.chunks[i] = (doc.page_content, n_tokens)
+        self.embeddings = embeddings
+        self.client = client
+        self.k = k
+
+    async def _retrieve(self, question):
+        vector = await self.embeddings.aembed_query(question)
+        # 索引里的向量已在 ingest 时归一化，查询向量同样归一化后用内积检索
+        query = np.asarray([vector], dtype="float32")
+        faiss.normalize_L2(query)
+        _, ids = self.index.search(query, self.k)
+        # 结果不足 k 条时 faiss 用 -1 补位
+        return [self.chunks[i] for i in ids[0] if i != -1]
+
+    async def _messages(self, question):
+        chunks = await self._retrieve(question)
+        context = format_docs(chunks, self.encoding, self.separator_tokens)
+        prompt = render_prompt(context, question)
+        return [{"role": "user", "content": prompt}]
+
+    async def ainvoke(self, question):
+        response = await self.client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=await self._messages(question),
+            temperature=0,
         )
-        print("✅ RAG Application is ready.")
+        return response.choices[0].message.content
+
+    async def astream(self, question):
+        stream = await self.client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=await self._messages(question),
+            temperature=0,
+            stream=True,
+        )
+        # 生成器提前关闭（客户端断开）时 async with 会关闭到 OpenAI 的响应
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+def get_rag_chain():
+    global rag_chain
+    if rag_chain is None:
+        # 启动预加载失败时，多个请求可能同时在线程里走到这里；
+        # 加锁并再次检查，保证索引只生成一次、RAG 链只构建一次
+        with _rag_chain_lock:
+            if rag_chain is not None:
+                return rag_chain
+            print("Loading RAG model and vector store...")
+        
+            # 确保索引存在（如果不存在会自动生成）
+            ensure_faiss_index()
+
+            # 1) 加载本地 FAISS 索引（ingest.py 预处理生成），并建立检索器
+            #    CachedEmbeddings 先查缓存；未命中的问题再由 BatchingEmbeddings 合并成一次 embeddings 调用
+            #    设置了 LOCAL_EMBEDDINGS_URL 时问题向量由本地 embedding 服务生成
+            base_embeddings = make_embeddings(http_client=_HTTPX, http_async_client=_HTTPX_ASYNC)
+            embeddings = CachedEmbeddings(
+                BatchingEmbeddings(base_embeddings),
+                _embedding_cache,
+                namespace=base_embeddings.model,
+            )
+            index, docstore, index_to_docstore_id = load_index()
+
+            # 2) LLM 直接用 openai SDK 调用（OpenAI gpt-3.5-turbo，temperature=0 让回答更稳定）
+            #    遇到 429 / 5xx / 连接错误时 SDK 自带指数退避重试
+            client = AsyncOpenAI(
+                http_client=_HTTPX_ASYNC, max_retries=OPENAI_MAX_RETRIES, timeout=LLM_TIMEOUT
+            )
+
+            # 3) 检索 -> Prompt -> LLM
+            rag_chain = RAGChain(index, docstore, index_to_docstore_id, embeddings, client)
+            print("✅ RAG Application is ready.")
     return rag_chain
 
 app = FastAPI()
+# 对 HTML 页面和较长的回答做 gzip 压缩（小于 500 字节的响应不压缩）；
+# text/event-stream 会被 GZipMiddleware 跳过，/chat/stream 的 token 不会被缓冲
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
+@app.on_event("startup")
+async def preload_rag_chain():
+    # 启动时预加载索引和模型，并提前完成到 OpenAI 的 DNS + TCP + TLS 握手，
+    # App Runner 冷启动后的第一个 /chat 请求不再承担这些开销。
+    # 索引加载放到线程里，与连接预热并行执行；加载失败时保留懒加载作为兜底
+    loaded, _ = await asyncio.gather(
+        asyncio.to_thread(get_rag_chain),
+        warm_openai_connection(),
+        return_exceptions=True,
+    )
+    if isinstance(loaded, Exception):
+        print(f"⚠️  WARNING: failed to preload RAG chain at startup: {loaded}")
+
+async def warm_openai_connection():
+    # 不带认证的 HEAD 请求会返回 401，这里只需要把连接放进 _HTTPX_ASYNC 的连接池
+    try:
+        await _HTTPX_ASYNC.head(f"{OPENAI_BASE_URL}/models")
+    except httpx.HTTPError as e:
+        print(f"⚠️  WARNING: failed to warm up OpenAI connection: {e}")
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    # 进程退出时关闭共享连接池
+    _HTTPX.close()
+    await _HTTPX_ASYNC.aclose()
 
 class Query(BaseModel):
     question: str
 
-@app.get("/", response_class=HTMLResponse)
-def read_root():
-    # 返回一个简单的 HTML 前端页面，让用户可以在浏览器中输入问题
-    html_content = """
+class BatchQuery(BaseModel):
+    questions: list[str]
+
+# 批量接口的最大并发数，避免一次性打满 OpenAI 的速率限制
+BATCH_CONCURRENCY = 16
+_batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+def to_http_exception(e):
+    # OpenAI 限流时返回 503，客户端和负载均衡器可以据此退避；其他错误返回 500
+    status_code = 503 if isinstance(e, RateLimitError) else 500
+    return HTTPException(status_code=status_code, detail=str(e))
+
+async def answer_question(chain, question):
+    # 先查回答缓存，未命中时再走完整的 RAG 链；
+    # diskcache 是同步的 SQLite 读写（且多个 worker 共用文件锁），放到线程里执行，不阻塞事件循环
+    answer = await asyncio.to_thread(_answer_cache.get, question)
+    if answer is None:
+        answer = await chain.ainvoke(question)
+        await asyncio.to_thread(_answer_cache.set, question, answer, expire=ANSWER_CACHE_TTL)
+    return answer
+
+# --- 前端页面：模块导入时编码一次，每次 GET / 直接返回同一份 bytes ---
+_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -199,10 +408,10 @@ def read_root():
                     },
                     body: JSON.stringify({ question: question })
                 })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        answerDiv.innerHTML = '<span class="error">错误: ' + data.error + '</span>';
+                .then(response => response.json().then(data => ({ ok: response.ok, data: data })))
+                .then(({ ok, data }) => {
+                    if (!ok) {
+                        answerDiv.innerHTML = '<span class="error">错误: ' + data.detail + '</span>';
                     } else {
                         answerDiv.innerHTML = '<strong>回答：</strong><br>' + data.answer;
                     }
@@ -224,15 +433,99 @@ def read_root():
     </body>
     </html>
     """
-    return html_content
+_HTML_BYTES = _HTML.encode("utf-8")
+# GZipMiddleware 会对同一个 ETag 返回 gzip / 未压缩两种表示，所以只能用弱 ETag
+_HTML_ETAG = 'W/"' + hashlib.sha1(_HTML_BYTES).hexdigest() + '"'
+_HTML_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": _HTML_ETAG}
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match 使用弱比较：可以是逗号分隔的多个值或 *，忽略 W/ 前缀
+    if not if_none_match:
+        return False
+    opaque = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque:
+            return True
+    return False
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
+    # 返回一个简单的 HTML 前端页面，让用户可以在浏览器中输入问题
+    # 页面内容在导入时就编码好，浏览器 / Cloudflare 带着 ETag 回来时直接返回 304
+    if etag_matches(request.headers.get("if-none-match"), _HTML_ETAG):
+        return Response(status_code=304, headers=_HTML_HEADERS)
+    return Response(content=_HTML_BYTES, media_type="text/html; charset=utf-8", headers=_HTML_HEADERS)
 
 @app.post("/chat")
-def chat(query: Query):
+async def chat(query: Query):
     try:
-        # Lazy load RAG chain on first use
-        chain = get_rag_chain()
-        answer = chain.invoke(query.question)
+        # 正常情况下 rag_chain 已在启动时加载；只有启动加载失败时才在线程里重试
+        chain = rag_chain or await asyncio.to_thread(get_rag_chain)
+        # ainvoke 全程走异步路径（检索的 embedding 和 LLM 都用 AsyncOpenAI），
+        # 等待 OpenAI 网络 I/O 时不占用线程，多个并发请求可以在事件循环上重叠
+        answer = await answer_question(chain, query.question)
         return {"answer": f"Helpful Answer: V2 {answer}"}
     except Exception as e:
-        # Return error message
-        return {"error": str(e)}, 500
+        logger.exception("/chat failed")
+        raise to_http_exception(e) from e
+
+@app.post("/chat/batch")
+async def chat_batch(body: BatchQuery):
+    try:
+        chain = rag_chain or await asyncio.to_thread(get_rag_chain)
+    except Exception as e:
+        logger.exception("/chat/batch failed")
+        raise to_http_exception(e) from e
+
+    async def answer_one(question):
+        async with _batch_semaphore:
+            return await answer_question(chain, question)
+
+    # 所有问题并发执行：检索的 embedding 请求和 LLM 请求都在同一波里发出，
+    # 总耗时接近单个最慢的问题，而不是 N 次串行往返
+    results = await asyncio.gather(
+        *(answer_one(q) for q in body.questions), return_exceptions=True
+    )
+    # 单个问题的失败只体现在响应里，这里逐个记录下来，便于排查（包括 OpenAI 限流）
+    for question, result in zip(body.questions, results):
+        if isinstance(result, Exception):
+            logger.error("/chat/batch question failed: %r", question, exc_info=result)
+    return {
+        "answers": [
+            {"error": str(r)} if isinstance(r, Exception) else {"answer": f"Helpful Answer: V2 {r}"}
+            for r in results
+        ]
+    }
+
+def sse_event(data, event=None):
+    # SSE 的 data 字段不能包含换行，多行内容拆成多条 data: 行，客户端会用 \n 拼回去
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return (f"event: {event}\n" if event else "") + lines + "\n"
+
+@app.post("/chat/stream")
+async def chat_stream(query: Query, request: Request):
+    # 逐 token 推送回答（Server-Sent Events），首字节时间从整段生成缩短到第一个 token
+    async def generate():
+        try:
+            chain = rag_chain or await asyncio.to_thread(get_rag_chain)
+            cached = await asyncio.to_thread(_answer_cache.get, query.question)
+            if cached is not None:
+                yield sse_event(cached)
+                return
+            tokens = []
+            # 客户端断开后停止生成，aclosing 保证 astream 立即被关闭，从而关闭对 OpenAI 的请求
+            async with aclosing(chain.astream(query.question)) as stream:
+                async for token in stream:
+                    if await request.is_disconnected():
+                        return
+                    tokens.append(token)
+                    yield sse_event(token)
+            await asyncio.to_thread(
+                _answer_cache.set, query.question, "".join(tokens), expire=ANSWER_CACHE_TTL
+            )
+        except Exception as e:
+            logger.exception("/chat/stream failed")
+            yield sse_event(str(e), event="error")
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
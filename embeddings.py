@@ -0,0 +1,216 @@
+import os
+import asyncio
+import hashlib
+import httpx
+from langchain_core.embeddings import Embeddings
+from openai import AsyncOpenAI, OpenAI
+
+# 这个模块放对 Embeddings 的包装，app.py 在构建 RAG 链时按需组合使用
+
+# 设置 LOCAL_EMBEDDINGS_URL 后改用本地 embedding 服务（例如 Infinity sidecar：
+#   infinity_emb v2 --model-id BAAI/bge-small-en-v1.5 --batch-size 64 --device cpu），
+# 问题编码不再需要往返 api.openai.com。ingest.py 和 app.py 必须使用同一个模型，切换后需要重新 ingest
+LOCAL_EMBEDDINGS_URL = os.environ.get("LOCAL_EMBEDDINGS_URL")
+LOCAL_EMBEDDINGS_MODEL = os.environ.get("LOCAL_EMBEDDINGS_MODEL", "BAAI/bge-small-en-v1.5")
+
+# OpenAI embedding 模型，与 OpenAIEmbeddings 的默认值一致，已有的索引和缓存仍然可用
+OPENAI_EMBEDDINGS_MODEL = "text-embedding-ada-002"
+
+
+def make_embeddings(http_client=None, http_async_client=None, length_safe=False):
+    """按配置返回本地 embedding 服务或 OpenAI SDK 的 embeddings，ingest 和查询共用
+
+    length_safe=True 时改用 OpenAIEmbeddings，超长文本会按 token 切开再合并，只在 ingest 时使用。
+    langchain_openai 导入一次要几百毫秒，所以只在这里按需导入，app.py 的启动路径不会加载它
+    """
+    if LOCAL_EMBEDDINGS_URL:
+        return LocalEmbeddings(
+            LOCAL_EMBEDDINGS_URL,
+            LOCAL_EMBEDDINGS_MODEL,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    if length_safe:
+        from langchain_openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(
+            model=OPENAI_EMBEDDINGS_MODEL,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    return OpenAISDKEmbeddings(
+        OPENAI_EMBEDDINGS_MODEL,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+
+class OpenAISDKEmbeddings(Embeddings):
+    """直接用 openai SDK 调用 embeddings 接口
+
+    文本原样发送，不经过 OpenAIEmbeddings 每次调用都要做的 tiktoken 分词
+    （在线程池里执行）和按长度重新分批；切片和问题都远小于模型的上下文长度，不需要这一步
+    """
+
+    def __init__(self, model: str, http_client=None, http_async_client=None):
+        self.model = model
+        self._client = OpenAI(http_client=http_client)
+        self._async_client = AsyncOpenAI(http_client=http_async_client)
+
+    @staticmethod
+    def _parse(response):
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+    def embed_documents(self, texts):
+        return self._parse(self._client.embeddings.create(model=self.model, input=texts))
+
+    async def aembed_documents(self, texts):
+        return self._parse(await self._async_client.embeddings.create(model=self.model, input=texts))
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class LocalEmbeddings(Embeddings):
+    """调用 OpenAI 兼容的本地 embedding 服务（POST {base_url}/embeddings）
+
+    动态批处理、fp16 推理都由服务端（Infinity）完成，这里只负责发请求和解析结果
+    """
+
+    def __init__(self, base_url: str, model: str, http_client=None, http_async_client=None):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self._client = http_client or httpx.Client(timeout=30.0)
+        self._async_client = http_async_client or httpx.AsyncClient(timeout=30.0)
+
+    def _payload(self, texts):
+        return {"model": self.model, "input": texts}
+
+    @staticmethod
+    def _parse(response):
+        response.raise_for_status()
+        data = sorted(response.json()["data"], key=lambda d: d["index"])
+        return [d["embedding"] for d in data]
+
+    def embed_documents(self, texts):
+        return self._parse(self._client.post(f"{self.base_url}/embeddings", json=self._payload(texts)))
+
+    async def aembed_documents(self, texts):
+        response = await self._async_client.post(f"{self.base_url}/embeddings", json=self._payload(texts))
+        return self._parse(response)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class BatchingEmbeddings(Embeddings):
+    """把短时间窗口内到达的多个 aembed_query 合并成一次 aembed_documents 请求
+
+    并发的 /chat 请求各自只需要编码一个问题；OpenAI 的 embeddings 接口一次可以接收多条输入，
+    合并后 N 个并发问题只需要一次 HTTP 往返。同步接口直接透传给内部的 Embeddings。
+    """
+
+    def __init__(self, inner: Embeddings, max_batch: int = 64, max_wait: float = 0.01):
+        self._inner = inner
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._queue = None
+        self._worker = None
+        # 持有正在执行的批次任务的引用，避免被垃圾回收
+        self._inflight = set()
+
+    def embed_documents(self, texts):
+        return self._inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._inner.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return await self._inner.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        # 后台收集任务在第一次调用时才启动，确保绑定到当前运行的事件循环
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 发送批次时不阻塞下一轮收集
+            task = asyncio.create_task(self._flush(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _flush(self, batch):
+        try:
+            vectors = await self._inner.aembed_documents([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+
+class CachedEmbeddings(Embeddings):
+    """给 embed_query / aembed_query 加一层缓存，重复的问题不再请求 OpenAI
+
+    cache 可以是任何支持 get / __setitem__ 的映射，app.py 里使用 diskcache.Cache，
+    重启后缓存依然有效。namespace 用来区分不同的 embedding 模型，避免换模型后命中旧向量。
+    异步接口里的缓存读写放到线程里执行，diskcache 的 SQLite 读写不会阻塞事件循环。
+    """
+
+    def __init__(self, inner: Embeddings, cache, namespace: str = ""):
+        self._inner = inner
+        self._cache = cache
+        self._namespace = namespace
+
+    def _key(self, text):
+        return hashlib.sha1(f"{self._namespace}\0{text}".encode("utf-8")).digest()
+
+    def embed_documents(self, texts):
+        return self._inner.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self._inner.aembed_documents(texts)
+
+    def embed_query(self, text):
+        key = self._key(text)
+        vector = self._cache.get(key)
+        if vector is None:
+            vector = self._inner.embed_query(text)
+            self._cache[key] = vector
+        return vector
+
+    async def aembed_query(self, text):
+        key = self._key(text)
+        vector = await asyncio.to_thread(self._cache.get, key)
+        if vector is None:
+            vector = await self._inner.aembed_query(text)
+            await asyncio.to_thread(self._cache.__setitem__, key, vector)
+        return vector
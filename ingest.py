@@ -1,28 +1,128 @@
 import os
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_community.document_loaders import TextLoader
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
+import asyncio
+import pickle
+import uuid
+import faiss
+import httpx
+import numpy as np
+import tiktoken
+from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from embeddings import LOCAL_EMBEDDINGS_URL, make_embeddings
 
 # 这个脚本负责把 data.txt 转成向量索引（FAISS）
 # 部署前先在本地运行一次，生成的 faiss_index 会被 Docker 镜像打包进去
+# app.py 在找不到索引时也会复用这里的函数自动生成
 
-# 1. 确认我们已经设置 OPENAI_API_KEY
-if "OPENAI_API_KEY" not in os.environ:
-    raise EnvironmentError("请先设置 OPENAI_API_KEY 环境变量")
+# HNSW 图索引参数：M 是每个节点的邻居数，efConstruction 越大建图越慢、召回越高
+# 检索复杂度从暴力扫描的 O(N·d) 降到近似 O(log N)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
 
-# 2. 加载原始文档（可以换成 PDF/CSV 等其他 Loader，这里用纯文本）
-loader = TextLoader("./data.txt")
-documents = loader.load()
+# 统计每个切片 token 数所用的分词器，需与 app.py 中的 LLM_MODEL 保持一致
+TOKENIZER_MODEL = "gpt-3.5-turbo"
 
-# 3. 将文档切成若干小块，方便后续做语义检索
-text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-docs = text_splitter.split_documents(documents)
+# 并发 embedding：每个请求 256 条文本，最多同时 8 个请求在途
+EMBED_BATCH_SIZE = 256
+EMBED_CONCURRENCY = 8
 
-# 4. 用 OpenAI Embeddings 把每个切片编码成向量，存进 FAISS
-embeddings = OpenAIEmbeddings()
-db = FAISS.from_documents(docs, embeddings)
 
-# 5. 把索引保存到本地目录（会生成 index.faiss / index.pkl）
-db.save_local("faiss_index")
-print("✅ FAISS index has been saved to 'faiss_index'")
\ No newline at end of file
+def split_text(text, chunk_size=1000, separator="\n\n"):
+    """按 separator 切分后把相邻片段合并成不超过 chunk_size 的块（chunk_overlap=0）
+
+    结果与 CharacterTextSplitter(chunk_size, chunk_overlap=0) 一致，但只做一次 str.split
+    和一次线性扫描，没有正则、length_function 回调和中间 Document 对象，
+    语料变大或者频繁重新 ingest 时切分不再是瓶颈
+    """
+    chunks = []
+    current = []
+    total = 0
+    for piece in text.split(separator):
+        if not piece:
+            continue
+        size = len(piece) + (len(separator) if current else 0)
+        if current and total + size > chunk_size:
+            chunk = separator.join(current).strip()
+            if chunk:
+                chunks.append(chunk)
+            current = []
+            total = 0
+            size = len(piece)
+        current.append(piece)
+        total += size
+    if current:
+        chunk = separator.join(current).strip()
+        if chunk:
+            chunks.append(chunk)
+    return chunks
+
+
+def load_documents(path="./data.txt"):
+    # 加载原始文档（纯文本），并切成若干小块，方便后续做语义检索
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    chunks = split_text(text, chunk_size=1000)
+    # 预先算好每个切片的 token 数存进 metadata，app.py 截断上下文时不必每次重新分词
+    encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    token_lists = encoding.encode_ordinary_batch(chunks)
+    return [
+        Document(page_content=chunk, metadata={"source": path, "n_tokens": len(tokens)})
+        for chunk, tokens in zip(chunks, token_lists)
+    ]
+
+
+async def embed_texts(texts, http_client=None):
+    # 分批并发调用 aembed_documents，总耗时约为 ceil(N/256)/8 次往返，而不是逐批串行
+    # 异步客户端在当前事件循环里创建并在结束时关闭，不会遗留绑定已关闭循环的连接
+    async with httpx.AsyncClient(timeout=30.0) as http_async_client:
+        embeddings = make_embeddings(
+            http_client=http_client, http_async_client=http_async_client, length_safe=True
+        )
+        semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+        async def embed_batch(batch):
+            async with semaphore:
+                return await embeddings.aembed_documents(batch)
+
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+        results = await asyncio.gather(*(embed_batch(b) for b in batches))
+    return [vector for batch in results for vector in batch]
+
+
+def build_index(docs, path="faiss_index", http_client=None):
+    # 1) 用 Embeddings 把每个切片编码成向量，一次性得到整个矩阵
+    vectors = np.asarray(
+        asyncio.run(embed_texts([d.page_content for d in docs], http_client)), dtype="float32"
+    )
+
+    # 2) 建 HNSW 索引代替默认的 IndexFlatL2，向量以 FP16 存储（标量量化），
+    #    每次检索读取的字节数减半，top-k 排序几乎不受影响；查询向量仍是 FP32，由 FAISS 内部转换
+    #    向量先归一化，再用内积（等价于余弦相似度）代替 L2 距离，每一维少一次减法
+    #    语料规模很大时可以换成 IndexIVFPQFastScan（nlist≈4*sqrt(N)，m=dim//4），内存再省 8-16 倍
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexHNSWSQ(
+        vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT
+    )
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.train(vectors)
+    index.add(vectors)
+
+    # 3) 文档本身存进 docstore，格式与 FAISS.save_local 保持一致（index.faiss / index.pkl）
+    ids = [str(uuid.uuid4()) for _ in docs]
+    docstore = InMemoryDocstore(dict(zip(ids, docs)))
+    index_to_docstore_id = dict(enumerate(ids))
+
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(index, os.path.join(path, "index.faiss"))
+    with open(os.path.join(path, "index.pkl"), "wb") as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+
+
+if __name__ == "__main__":
+    # 使用 OpenAI Embeddings 时确认我们已经设置 OPENAI_API_KEY
+    if not LOCAL_EMBEDDINGS_URL and "OPENAI_API_KEY" not in os.environ:
+        raise EnvironmentError("请先设置 OPENAI_API_KEY 环境变量")
+
+    docs = load_documents()
+    build_index(docs)
+    print("✅ FAISS index has been saved to 'faiss_index'")